@@ -14,16 +14,25 @@ Unique Agent ID - Also referred to as the Agent ID (AID), the unique ID of a sen
 
 Requirements:
 - Falcon API client ID and its secret. The API client must include scope of 'Hosts: Read'
-- FalconPy SDK
+- FalconPy SDK, a release that accepts a requests.Session for connection pooling
 - Python 3.7 or later is required for the FalconPy SDK. The script was initially written and tested
   with Python 3.10. Please keep this in mind for compatibility of changes in the future.
 - Flask is required for this iteration which operates through a web page.
 """
 # -*- coding: utf-8 -*-
 import concurrent.futures
-import re
+import csv
+import functools
+import io
+import os
+import threading
+import time
+from collections import defaultdict
 
-from flask import Flask, render_template, request
+import requests
+from flask import Flask, Response, render_template, request, stream_with_context
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from falconpy import Hosts
 
@@ -43,182 +52,404 @@ cid_dict = {
     "09876123456mnbvzxcvbasdftygwk": "Acronyms R Us",
 }
 
+CLIENT_ID = "REDACTED"
+CLIENT_SECRET = "REDACTED"
+
+# Column names for the CSV results, in the order cs_detail_search writes them
+CSV_HEADERS = (
+    "Hostname", "Found", "Agent Version", "Last Check-in Time", "First Check-in Time",
+    "Tags", "Customer ID", "Cloud Instance ID", "Unique Agent ID",
+)
+
+# Number of names OR'd into a single FQL filter per query_devices_by_filter_scroll call
+BATCH_SIZE = 100
+# AIDs per get_device_details call
+DETAILS_BATCH_SIZE = 100
+# Matches allowed per name searched. A batched query may return MATCH_LIMIT matches per
+# name in the batch. A batch that fills that limit is split until every part fits, so no
+# name is crowded out by a broader one, and each name's rows are capped at MATCH_LIMIT
+# when the details are matched back to the names
+MATCH_LIMIT = 50
+# Most records requested from a single query_devices_by_filter_scroll call
+SCROLL_LIMIT = 5000
+
+# Shared pool for the batched searches, reused across submissions. Test response times
+# if committing changes to FALCON_WORKERS. Oversized pools only add contention against
+# the API rate limits, and batching already keeps the number of calls small.
+WORKERS = int(os.getenv("FALCON_WORKERS", "16"))
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=WORKERS, thread_name_prefix="falcon"
+)
+# Connect and read timeouts, in seconds, for every Falcon API call
+API_TIMEOUT = (30, 180)
+
+# FQL filter for each searchable field, formatted with a single name
+NAME_FILTERS = {
+    "instance_id": "instance_id:*'*{}*'",
+    "hostname": "hostname:*'{}*'",
+}
+
+# Per-name search results, keyed on (field, lowercase name) and holding (stored time, AIDs).
+# Operators often resubmit overlapping lists, so names are only searched again once their
+# entry is older than CACHE_TTL seconds. Expired entries are kept as a fallback for when
+# the API errors on the repeat search.
+CACHE_TTL = int(os.getenv("FALCON_CACHE_TTL", "300"))
+CACHE_MAXSIZE = 50_000
+search_cache = {}
+search_cache_lock = threading.Lock()
+
 
 def file_parse(submitted_list):
-    """Takes text list of names provided, removes trailing whitespace,
-    and uses RegEx to split instance IDs from hostnames for return"""
-
-    # Clean list
-    host_items_split = [host for host in submitted_list.split("\n")]
-    host_list = [i.strip() for i in host_items_split]
-    while "" in host_list:
-        host_list.remove("")
-    
-    # Check if too many names were entered. If so, return false values to main()
-    host_list_len = len(host_list)
-    print("Number of hosts entered: ", str(host_list_len))
-    if len(host_list) > 5000:
-        print(
-            "More than 5,000 names entered. Script will inform user it will not proceed"
-        )
-        return (False, False)
-    
-    # Create two lists, separate instance IDs from hostnames
+    """Takes text list of names provided, removes trailing whitespace, domains and
+    duplicates, and splits instance IDs from hostnames for return. Returns None
+    if more than 5000 names were entered"""
+
+    # Clean list and separate instance IDs from hostnames in a single pass
     iname_list, hname_list = [], []
-    for host_or_id in host_list:
-        # Remove domains and leave base hostname
-        host_or_id = re.sub(r"\..*", "", host_or_id)
-        if re.match(r"^i-\b.*$", host_or_id):
+    seen = set()
+    for host_or_id in submitted_list.splitlines():
+        # Remove whitespace and domains to leave base hostname, skipping blank lines
+        # and repeats. Searches are case-insensitive so duplicates are too
+        host_or_id = host_or_id.strip().split(".", 1)[0]
+        if not host_or_id or host_or_id.lower() in seen:
+            continue
+        seen.add(host_or_id.lower())
+        if host_or_id.startswith("i-"):
             iname_list.append(host_or_id)
         else:
             hname_list.append(host_or_id)
+
+    # Check if too many names were entered. If so, return None to upload_file()
+    host_list_len = len(iname_list) + len(hname_list)
+    print("Number of hosts entered: ", str(host_list_len))
+    if host_list_len > 5000:
+        print(
+            "More than 5,000 names entered. Script will inform user it will not proceed"
+        )
+        return None
     
     return (iname_list, hname_list)
 
+@functools.lru_cache(maxsize=None)
+def get_falcon():
+    """Creates the Hosts client once and reuses it for every submission. FalconPy renews
+    the OAuth2 token as needed, and the pooled session keeps connections alive across
+    the search worker threads and subsequent submissions. Every call goes to the one
+    API host, so the pool holds one kept-alive connection per worker and never more"""
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=WORKERS,
+            pool_block=True,
+            max_retries=Retry(total=3, backoff_factor=0.2),
+        ),
+    )
+    return Hosts(
+        client_id=CLIENT_ID,
+        client_secret=CLIENT_SECRET,
+        session=session,
+        timeout=API_TIMEOUT,
+    )
+
+def csv_row(*fields):
+    """Formats fields as a single CSV line, quoting any that contain commas or quotes"""
+    row = io.StringIO()
+    csv.writer(row, lineterminator="").writerow(fields)
+    return row.getvalue()
+
+def chunked(seq, size):
+    """Yields successive slices of seq holding at most size items"""
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+def cache_get(key, allow_stale=False):
+    """Returns the cached AIDs for a searched name, or None if missing or expired"""
+    with search_cache_lock:
+        entry = search_cache.get(key)
+    if entry is None or (not allow_stale and time.monotonic() - entry[0] > CACHE_TTL):
+        return None
+    return entry[1]
+
+def cache_put(key, aids):
+    """Caches the AIDs a searched name matched. Evicts the oldest entries past CACHE_MAXSIZE"""
+    with search_cache_lock:
+        search_cache.pop(key, None)
+        search_cache[key] = (time.monotonic(), aids)
+        while len(search_cache) > CACHE_MAXSIZE:
+            del search_cache[next(iter(search_cache))]
+
+def matching_names(value, searched_names, prefix_only):
+    """Yields the lowercase searched names found in a host field. Mirrors the search
+    filters: instance IDs match anywhere in the ID, hostnames match as a prefix. Only
+    fragments as long as some searched name are tested, so no index of the host is built"""
+    value = value.lower()
+    found = set()
+    for length in {len(name) for name in searched_names}:
+        starts = range(1) if prefix_only else range(len(value) - length + 1)
+        for start in starts:
+            fragment = value[start:start + length]
+            if len(fragment) == length and fragment in searched_names:
+                found.add(fragment)
+    return found
+
+def get_details(falcon, batch):
+    """Fetch details for a batch of AIDs. Returns None if the API call failed"""
+    details = falcon.get_device_details(ids=batch)
+    if details["status_code"] != 200:
+        return None
+    return details["body"]["resources"]
+
 def cs_query_devices(falcon, iname_list, hname_list):
-    """Gets Host IDs/AIDs from hostnames or instance IDs,
-    which are later used to return desired host details"""
+    """Gets Host IDs/AIDs from hostnames or instance IDs and queues the desired host
+    details for them. Names are OR'd together into one FQL filter per batch so each API
+    call covers up to BATCH_SIZE names instead of one. A batch whose results reach its
+    limit may be truncated, so it is split in half and searched again until each part
+    returns fewer, or is a single name capped at MATCH_LIMIT. Names searched within
+    CACHE_TTL seconds are answered from the cache. Details are requested as soon as a full
+    batch of new AIDs is known, so the detail calls overlap the remaining searches"""
 
-    is_found = False
-    aid_list = []
     host_info_list = []
+    # (field, names, AIDs, complete) for every name whose AIDs are queued. All of them are
+    # matched back in cs_detail_search to cap each name's rows. Only complete batches are
+    # cross-referenced to report and cache the names that matched no host, unless details
+    # failed for any of the batch's AIDs
+    searched = []
+    pending = {"instance_id": [], "hostname": []}
+    # Overlapping partial names match the same hosts. Keep one of each, in order
+    seen_aids = set()
+    unqueued_aids = []
+    # Detail lookups in flight, mapped to the AIDs each one covers
+    detail_futures = {}
 
-    def search_inames(iname):
-        """Search by instance ID"""
-        aid = None
-        iname_search = falcon.query_devices_by_filter_scroll(
-            # Search limited to 50 matches. Default limit is 100. Set to balance finding partial
-            # matches/duplicates while limiting misuse for environment discovery with partial names
-            limit = 50,
-            # Sorts most recently seen matches to the top
-            sort="last_seen.desc",
-            filter=f"instance_id:*'*{iname}*'",
-        )
+    def queue_details(aids, flush=False):
+        """Submit detail lookups for new AIDs in batches of DETAILS_BATCH_SIZE"""
+        for aid in aids:
+            if aid not in seen_aids:
+                seen_aids.add(aid)
+                unqueued_aids.append(aid)
+        while len(unqueued_aids) >= DETAILS_BATCH_SIZE or (flush and unqueued_aids):
+            batch = unqueued_aids[:DETAILS_BATCH_SIZE]
+            del unqueued_aids[:DETAILS_BATCH_SIZE]
+            detail_futures[EXECUTOR.submit(get_details, falcon, batch)] = batch
+
+    def use_cached(field, name, aids):
+        """Report a name from its cached AIDs instead of searching it"""
+        searched.append((field, [name], aids, False))
+        if not aids:
+            host_info_list.append(csv_row(name, False))
+        return aids
 
-        if iname_search["status_code"] == 200:
-            aid = iname_search["body"]["resources"]
-            if aid:
-                aid_list.append(aid)
+    for field, names in (("instance_id", iname_list), ("hostname", hname_list)):
+        for name in names:
+            aids = cache_get((field, name.lower()))
+            if aids is None:
+                pending[field].append(name)
             else:
-                device_details = f"{iname},{is_found}"
-                host_info_list.append(device_details)
-        # If status_code on API call is not 200 then there was an error. Note and skip.
-        else:
-            host_info_list.append(
-                f"{iname}, Search experienced an error. "
-                "Please try this name again in a smaller search list."
-            )
-    
-    def search_hnames(hname):
-        """Search by system hostname"""
-        aid = None
-        hname_search = falcon.query_devices_by_filter_scroll(
-            # Search limited to 50 matches. Default limit is 100. Relevant to duplicate names.
-            limit = 50,
+                queue_details(use_cached(field, name, aids))
+
+    def search_batch(batch, field):
+        """Search a batch of names with a single FQL filter. Returns the matched AIDs and
+        any halves of the batch that still need searching"""
+        # Search limited to 50 matches per name. Default limit is 100. Set to balance finding
+        # partial matches/duplicates while limiting misuse for environment discovery with partial names
+        limit = min(MATCH_LIMIT * len(batch), SCROLL_LIMIT)
+        batch_search = falcon.query_devices_by_filter_scroll(
+            limit = limit,
             # Sorts most recently seen matches to the top
             sort = "last_seen.desc",
-            filter = f"hostname:*'{hname}*'",
+            filter = ",".join(NAME_FILTERS[field].format(name) for name in batch),
         )
 
-        if hname_search["status_code"] == 200:
-            aid = hname_search["body"]["resources"]
-            if aid:
-                aid_list.append(aid)
-            else:
-                device_details = f"{hname},{is_found}"
-                host_info_list.append(device_details)
-        # If status_code on API call is not 200 then there was an error. Note and skip.
-        else:
-            host_info_list.append(
-                f"{hname}, Search experienced a transient error. "
+        if batch_search["status_code"] == 200:
+            aids = batch_search["body"]["resources"]
+            if len(aids) < limit:
+                searched.append((field, batch, aids, True))
+                return (aids, [])
+            # A single name at the limit keeps its most recent matches, as before batching,
+            # but its result is incomplete so it is neither cached nor reported not found
+            if len(batch) == 1:
+                searched.append((field, batch, aids, False))
+                return (aids, [])
+            half = len(batch) // 2
+            return ([], [batch[:half], batch[half:]])
+        # If status_code on API call is not 200 then there was an error. Fall back to
+        # any expired cache entry, otherwise note and skip.
+        aid_list = []
+        for name in batch:
+            aids = cache_get((field, name.lower()), allow_stale=True)
+            if aids is not None:
+                aid_list.extend(use_cached(field, name, aids))
+                continue
+            host_info_list.append(csv_row(
+                name,
+                "Search experienced a transient error. "
                 "Please try this name again in a smaller search list."
-            )
-    """Execute iname and hname searches with multithreading. Test response times if committing
-    changes to max_workers. 200 or 300 may actually take longer than 100 depending on search size."""
-    with concurrent.futures.ThreadPoolExecutor(max_workers=100) as executor:
-        executor.map(search_inames, iname_list)
-        executor.map(search_hnames, hname_list)
-
-    # Flatten aid_list to prevent incomplete data output caused by sub-lists
-        aid_list = [i for sub_list in aid_list for i in sub_list]
-        print("Number of Falcon Sensors Found:", len(aid_list))
-        print("Names not found:", len(host_info_list))
-
-        return (aid_list, host_info_list)
-    
-def cs_detail_search(falcon, aid_list, host_info_list):
-    """Retrieve host details using the collected AIDs, if 5000 or fewer. While
-    we could break up large numbers of results into multiple lists and query them
-    in batches of 5000 we want to dissuade users from reckless and costly partial searches"""
-
-    if len(aid_list) == 0:
-        host_info_list.append(
-            "Names provided were not found managed in CrowdStrike Falcon. "
-            "If some names reported a transient API error then please try them in a new search."
+            ))
+        return (aid_list, [])
+    # Execute batched iname and hname searches on the shared pool, resubmitting the halves
+    # of any truncated batch. Collecting each result re-raises any exception from the worker
+    futures = {
+        EXECUTOR.submit(search_batch, batch, field): field
+        for field, names in pending.items()
+        for batch in chunked(names, BATCH_SIZE)
+    }
+    while futures:
+        done, _ = concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_COMPLETED
         )
+        for future in done:
+            field = futures.pop(future)
+            aids, splits = future.result()
+            queue_details(aids)
+            for split in splits:
+                futures[EXECUTOR.submit(search_batch, split, field)] = field
+    queue_details((), flush=True)
+
+    print("Number of Falcon Sensors Found:", len(seen_aids))
+    print("Names not found or with search errors:", len(host_info_list))
+
+    return (detail_futures, searched, host_info_list)
     
-    elif 0 < len(aid_list) <= 5000:
-        details_response = falcon.get_device_details(ids=aid_list)["body"]["resources"]
-        for detail in details_response:
-            # Get basic variables
-            is_found = True
-            hostname = detail["hostname"]
-            host_id = detail["device_id"]
-            agent_version = detail["agent_version"]
-            last_seen = detail["last_seen"]
-            first_seen = detail["first_seen"]
+def cs_detail_search(detail_futures, searched, host_info_list):
+    """Yields the rows noted by cs_query_devices, then the host details it queued as
+    each batch arrives so results stream out without holding them all in memory.
+    Each name shows at most MATCH_LIMIT hosts, the first to arrive. Searched names that
+    match none of the returned hosts are reported as not found last.
+    A failed detail batch is reported in its own row, and names whose search matched
+    any of its AIDs are neither reported as not found nor cached"""
+
+    yield from host_info_list
+
+    # Lowercase forms of the names to cross-reference. Only the AIDs of the hosts
+    # they match are kept, as each detail arrives
+    searched_names = {"instance_id": set(), "hostname": set()}
+    for field, names, _, _ in searched:
+        searched_names[field].update(name.lower() for name in names)
+    matched = defaultdict(list)
+    failed_aids = set()
+    cid_name_get = cid_dict.get
+    is_found = True
+    any_details = bool(detail_futures)
+    for future in concurrent.futures.as_completed(detail_futures):
+        # Drop each future once its rows are written so its response can be released
+        batch = detail_futures.pop(future)
+        # The response has already started, so a failed batch, whether an API error or
+        # an exception, is reported in the CSV rather than ending the stream
+        try:
+            details = future.result()
+        except Exception as details_error:  # pylint: disable=broad-except
+            print("Details lookup failed:", details_error)
+            details = None
+        if details is None:
+            failed_aids.update(batch)
+            yield csv_row(
+                f"Details for {len(batch)} hosts experienced a transient error. "
+                "Please try this search again.",
+                ";".join(batch),
+            )
+            continue
+        for detail in details:
+            # Get basic variables. Fields missing from a record are left blank. Optional
+            # fields can also be present with a null value, so fall back with "or"
+            get = detail.get
+            hostname = get("hostname")
+            host_id = get("device_id")
+            agent_version = get("agent_version")
+            last_seen = get("last_seen")
+            first_seen = get("first_seen")
 
             # Instance ID
-            try:
-                instance_id = detail["instance_id"]
-            except KeyError:
-                instance_id = "N/A"
-            
+            instance_id = get("instance_id") or "N/A"
+
+            # Skip hosts that only match names already showing MATCH_LIMIT hosts
+            names = [
+                (field, name)
+                for field, prefix_only, value in (
+                    ("instance_id", False, get("instance_id") or ""),
+                    ("hostname", True, hostname or ""),
+                )
+                for name in matching_names(value, searched_names[field], prefix_only)
+            ]
+            under_limit = [key for key in names if len(matched[key]) < MATCH_LIMIT]
+            if names and not under_limit:
+                continue
+            for key in under_limit:
+                matched[key].append(host_id)
+
             # Convert tags from list to string, delimit with ; to
             # avoid issue with CVS output of multiple tags
-            try:
-                tags = detail["tags"]
-                tags = ";".join(tags)
-            except KeyError:
-                tags = "N/A"
-            
+            tags = get("tags")
+            tags = "N/A" if tags is None else ";".join(tags)
+
             # Attempt to provide friendly CID name via CID dictionary
-            cid = detail["cid"]
-            cid_name = cid_dict.get(cid, "Name not found")
-            cid = f"{cid_name} : {cid}"
+            cid = get("cid")
+            cid = f"{cid_name_get(cid, 'Name not found')} : {cid}"
 
-            # Finally, format device details in correct order and append to list
-            device_details = f"{hostname},{is_found},{agent_version},{last_seen}\
-                ,{first_seen},{tags},{cid},{instance_id},{host_id}"
-            host_info_list.append(device_details)
+            # Finally, format device details in correct order and output the row
+            yield csv_row(
+                hostname, is_found, agent_version, last_seen,
+                first_seen, tags, cid, instance_id, host_id
+            )
 
-    else:
-        host_info_list.append(
-            f"{len(aid_list)} hosts found. Please reduce the number of partial "
-            "names to stay under 5000 results. Any names above that reported "
-            "IsFound as False were confirmed not to be found."
+    # Cache what each searched name matched and report the names not found. Matches
+    # for a batch whose AIDs were not all detailed are incomplete, so skip caching them
+    for field, names, batch_aids, complete in searched:
+        if not complete:
+            continue
+        incomplete = not failed_aids.isdisjoint(batch_aids)
+        for name in names:
+            aids = matched.get((field, name.lower()), [])
+            if incomplete:
+                if not aids:
+                    yield csv_row(
+                        name,
+                        "Host details lookup experienced a transient error, so this name "
+                        "could not be confirmed. Please try the search again."
+                    )
+                continue
+            cache_put((field, name.lower()), aids)
+            if not aids:
+                yield csv_row(name, False)
+    if not any_details:
+        yield (
+            "Names provided were not found managed in CrowdStrike Falcon. "
+            "If some names reported a transient API error then please try them in a new search."
         )
-    
-    return host_info_list
 
 
 @app.route("/submit", methods=["GET", "POST"])
 def upload_file():
-    """Triggers when the Submit button is clicked on home.html page. Runs API search."""
-    client_id = "REDACTED"
-    client_secret = "REDACTED"
+    """Triggers when the Submit button is clicked on home.html page. Runs API search
+    and streams the results back as a CSV download."""
     submitted_list = request.form["textarea"]
-    iname_list, hname_list = file_parse(submitted_list)
+    parsed = file_parse(submitted_list)
 
-    if iname_list and hname_list == False:
-        host_info_list = [
+    if parsed is None:
+        host_info_rows = [
             "Too many names to search. Please try again with fewer than 5000 names."
         ]
     
     else:
-        falcon = Hosts(client_id=client_id, client_secret=client_secret)
-        aid_list, host_info_list = cs_query_devices(falcon, iname_list, hname_list)
-        host_info_list = cs_detail_search(falcon, aid_list, host_info_list)
+        iname_list, hname_list = parsed
+        falcon = get_falcon()
+        detail_futures, searched, host_info_list = cs_query_devices(
+            falcon, iname_list, hname_list
+        )
+        host_info_rows = cs_detail_search(detail_futures, searched, host_info_list)
+
+    def generate_rows():
+        """Output the CSV header, then each row as soon as it is ready"""
+        yield csv_row(*CSV_HEADERS) + "\n"
+        for row in host_info_rows:
+            yield row + "\n"
+
+    return Response(
+        stream_with_context(generate_rows()),
+        mimetype="text/csv",
+        headers={"Content-Disposition": "attachment; filename=host_search_results.csv"},
+    )
 
 
 if __name__ == "__main__":
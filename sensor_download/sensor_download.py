@@ -8,7 +8,7 @@ https://github.com/CrowdStrike/falconpy/tree/main/samples/sensor_download
 
 Requirements:
 - Falcon API key with scope 'Sensor Download: Read'
-- FalconPy SDK
+- FalconPy SDK, a release that supports streaming downloads (stream=True)
 
 Sample Windows command to download N-1 sensors from all OSes:
 python "C:\Folder\Other Folder\download_sensors.py" -k clientidgoeshere -s clientsecretgoeshere -n 1 -a -d
@@ -27,6 +27,8 @@ recently changed."
 """
 import os
 from argparse import ArgumentParser, RawTextHelpFormatter
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tabulate import tabulate
 try:
     from falconpy import APIHarness
@@ -35,6 +37,23 @@ except ImportError as no_falconpy:
         "The CrowdStrike SDK must be installed in order to use this utility.\n"
         "Install this application with the command `python3 -m pip install crowdstrike-falconpy`."
     ) from no_falconpy
+from requests.exceptions import RequestException
+
+# Accepted --os values, mapped to the OS label used by the sensor download API
+OS_ALIASES = {
+    alias: os_label
+    for os_label, aliases in {
+        "RHEL/CentOS/Oracle": ("rhel", "centos", "oracle", "rhel/centos/oracle"),
+        "Amazon Linux": ("amzn", "az", "amazon", "amazon linux"),
+        "SLES": ("sles", "suse"),
+        "Debian": ("ubuntu", "kali", "deb", "debian"),
+        "Windows": ("win", "windows", "microsoft"),
+        "macOS": ("mac", "macos", "apple"),
+        "Container": ("container", "docker", "kubernetes"),
+        "Identity*": ("idp", "identity", "identity protection"),
+    }.items()
+    for alias in aliases
+}
 
 def consume_arguments():
     """Consume any provided command line arguments."""
@@ -85,68 +104,70 @@ def consume_arguments():
                         )
     return parser.parse_args()
 
-def get_version_map(sensor_versions: list):  # pylint: disable=R0914
+def get_version_map(sensor_versions: list):
     """Create a mapping of all available sensor versions."""
-    version_map = {
-        "windows": {},
-        "mac": {},
-        "linux": {}
-    }
-
+    # Group every installer under its platform and OS label in a single pass
+    grouped = defaultdict(list)
     for version in sensor_versions["body"]["resources"]:
-        ver = version.get("version", None)
         plat = version.get("platform", None)
         os_name = version.get("os", None)
-        os_ver = version.get("os_version", None)
-        name = version.get("name", None)
-        desc = version.get("description", None)
-        sha = version.get("sha256", None)
-        tracked = False
-        current = False
-        prev = False
-        eldest = False
         if plat and os_name:
-            for os_type, os_detail in version_map.get(plat, {}).items():
-                if os_type == f"{os_name} {os_ver}".strip():
-                    if not os_detail.get("current", {}):
-                        os_detail["current"] = {}
-                        os_detail["current"]["name"] = name
-                        os_detail["current"]["version"] = ver
-                        os_detail["current"]["description"] = desc
-                        os_detail["current"]["sha256"] = sha
-                        tracked = True
-                    else:
-                        current = True
-                    if current and not os_detail.get("previous", {}):
-                        os_detail["previous"] = {}
-                        os_detail["previous"]["name"] = name
-                        os_detail["previous"]["version"] = ver
-                        os_detail["previous"]["description"] = desc
-                        os_detail["previous"]["sha256"] = sha
-                        tracked = True
-                    elif current and os_detail.get("previous", {}):
-                        prev = True
-                    if current and prev and not os_detail.get("oldest", {}):
-                        os_detail["oldest"] = {}
-                        os_detail["oldest"]["name"] = name
-                        os_detail["oldest"]["version"] = ver
-                        os_detail["oldest"]["description"] = desc
-                        os_detail["oldest"]["sha256"] = sha
-                        tracked = True
-                    elif current and prev and os_detail.get("oldest", {}):
-                        eldest = True
+            os_type = f"{os_name} {version.get('os_version', '')}".strip()
+            grouped[(plat, os_type)].append(version)
 
-            if not tracked and not current and not prev and not eldest:
-                version_map[plat][f"{os_name} {os_ver}".strip()] = {}
-                version_map[plat][f"{os_name} {os_ver}".strip()]["current"] = {
-                    "name": name,
-                    "version": ver,
-                    "description": desc,
-                    "sha256": sha
-                }
+    version_map = {
+        "windows": {},
+        "mac": {},
+        "linux": {}
+    }
+    # Newest release is current, then previous and oldest, regardless of response order
+    for (plat, os_type), versions in grouped.items():
+        versions.sort(key=lambda ver: ver.get("release_date", ""), reverse=True)
+        version_map.setdefault(plat, {})[os_type] = {
+            label: {
+                "name": version.get("name", None),
+                "version": version.get("version", None),
+                "description": version.get("description", None),
+                "sha256": version.get("sha256", None)
+            }
+            for label, version in zip(("current", "previous", "oldest"), versions)
+        }
 
     return version_map
 
+def download_sensor(sdk, task: tuple):
+    """Download a single sensor installer into its OS folder."""
+    dl_desc, dl_ver, dir_name, fname, sha_to_retrieve = task
+    os.makedirs(dir_name, exist_ok=True)
+    print(f"Downloading {dl_desc} version {dl_ver}")
+    # Stream the installer to disk in chunks rather than holding it all in memory
+    download = sdk.command(action="DownloadSensorInstallerById",
+                           id=sha_to_retrieve,
+                           stream=True
+                           )
+    # Failures before the request is sent (e.g. connection or token errors) come back
+    # from FalconPy as a result dictionary rather than a streamed response
+    if isinstance(download, dict):
+        errors = download.get("body", {}).get("errors", [])
+        print(f"Download of {dl_desc} version {dl_ver} failed with status "\
+              f"{download.get('status_code')}: {errors}")
+        return
+    save_path = os.path.join(dir_name, fname)
+    with download:
+        if not download.ok:
+            print(f"Download of {dl_desc} version {dl_ver} failed with status "\
+                  f"{download.status_code}.")
+            return
+        try:
+            with open(save_path, "wb") as save_file:
+                for chunk in download.iter_content(chunk_size=1 << 20):
+                    save_file.write(chunk)
+        except (RequestException, OSError) as dl_error:
+            # Don't leave a truncated installer behind
+            if os.path.exists(save_path):
+                os.remove(save_path)
+            print(f"Download of {dl_desc} version {dl_ver} failed partway: {dl_error}")
+
 def create_constants():
     """Create constants from the provided command-line arguments."""
     args = consume_arguments()
@@ -154,29 +175,15 @@ def create_constants():
     if args.download:
         cmd = "download"
 
-    os_name = ""
-    if args.os:
-        check_os = args.os.lower()
-        if check_os in ["rhel", "centos", "oracle", "rhel/centos/oracle"]:
-            os_name = "RHEL/CentOS/Oracle"
-        if check_os in ["amzn", "az", "amazon", "amazon linux"]:
-            os_name = "Amazon Linux"
-        if check_os in ["sles", "suse"]:
-            os_name = "SLES"
-        if check_os in ["ubuntu", "kali", "deb", "debian"]:
-            os_name = "Debian"
-        if check_os in ["win", "windows", "microsoft"]:
-            os_name = "Windows"
-        if check_os in ["mac", "macos", "apple"]:
-            os_name = "macOS"
-        if check_os in ["container", "docker", "kubernetes"]:
-            os_name = "Container"
-        if check_os in ["idp", "identity", "identity protection"]:
-            os_name = "Identity*"
+    os_name = OS_ALIASES.get(args.os.lower(), "")
 
-    os_filter = ""
+    # Filter server-side so only the requested OS / OS version rows come back
+    os_filter = []
     if os_name:
-        os_filter = f"os:'{str(os_name)}'"
+        os_filter.append(f"os:'{str(os_name)}'")
+    if args.osver:
+        os_filter.append(f"os_version:'{args.osver}'")
+    os_filter = "+".join(os_filter)
 
     return cmd, args.key, args.secret, os_filter, args.filename, args.table_format, args.all, \
         args.osver, args.nminus
@@ -193,7 +200,6 @@ sensors = falcon.command(action="GetCombinedSensorInstallersByQuery",
                          )
 if CMD in "list":
     # List sensors
-    data = []
     headers = {
             "name": "Name",
             "description": "Description",
@@ -212,15 +218,11 @@ if CMD in "list":
         headers.pop("sha256")
         headers.pop("file_size")
         headers.pop("file_type")
-    for sensor in sensors["body"]["resources"]:
-        if OSVER in [sensor["os_version"], ""]:
-            if not SHOW_ALL:
-                sensor.pop("description")
-                sensor.pop("platform")
-                sensor.pop("sha256")
-                sensor.pop("file_size")
-                sensor.pop("file_type")
-            data.append(sensor)
+    # Keep only the displayed columns, leaving the API response untouched
+    data = [
+        {key: sensor[key] for key in headers if key in sensor}
+        for sensor in sensors["body"]["resources"]
+    ]
     # Show results
     if len(data) == 0:
         print("No results, check your filter and try your query again.")
@@ -236,8 +238,9 @@ elif CMD in "download":
             NMVER = "previous"
         elif int(NMINUS) == 2:
             NMVER = "oldest"
-    dl_complete = []
-    # Download sensors
+    dl_complete = set()
+    # Work out every sensor to download, then fetch them in parallel
+    downloads = []
     DO_DOWNLOAD = True
     for sensor in sensors["body"]["resources"]:
         full_name = f"{sensor['os']} {sensor['os_version']}".strip()
@@ -252,8 +255,6 @@ elif CMD in "download":
                               "label likely was recently changed.")
                         continue
                     dir_name = f"{sensor['os']} {sensor['os_version']}".replace('/',' ')
-                    if not os.path.exists(dir_name):
-                        os.makedirs(dir_name)
                     dl_desc = version_detail[plat_spec][full_name][NMVER]['description']
                     dl_ver = version_detail[plat_spec][full_name][NMVER]['version']
                     if not FILENAME:
@@ -263,15 +264,15 @@ elif CMD in "download":
                             dir_name = f"{sensor['os']}"
                     else:
                         fname=FILENAME
-                    print(f"Downloading {dl_desc} version {dl_ver}")
-                    download = falcon.command(
-                        action="DownloadSensorInstallerById",
-                        id=sha_to_retrieve
-                        )
-                    with open(os.path.join(dir_name, fname), "wb") as save_file:
-                        save_file.write(download)
-                    dl_complete.append(full_name)
+                    downloads.append((dl_desc, dl_ver, dir_name, fname, sha_to_retrieve))
+                    dl_complete.add(full_name)
                     if not SHOW_ALL:
                         DO_DOWNLOAD = False
+    # Downloads are IO bound, so a handful of threads overlap them without
+    # saturating the connection to CrowdStrike
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(download_sensor, falcon, task) for task in downloads]
+        for future in as_completed(futures):
+            future.result()
 else:
     print("Stop mumbling!")